@@ -5,9 +5,13 @@ Example usage scripts for the Gemini API wrapper
 
 import time
 import json
+import threading
 import requests
 from gemini_api import GeminiAPI
 
+# Shared session so REST calls reuse keep-alive connections
+SESSION = requests.Session()
+
 def example_basic_usage():
     """Basic API usage example"""
     print("=== Basic Usage Example ===\n")
@@ -60,10 +64,13 @@ def example_async_processing():
     api = GeminiAPI()
     
     results = []
+    done = threading.Event()
     
     def callback(result):
         results.append(result)
         print(f"Received response {len(results)}")
+        if len(results) == len(prompts):
+            done.set()
     
     # Queue multiple async requests
     prompts = [
@@ -78,8 +85,7 @@ def example_async_processing():
     
     # Wait for all to complete
     print("\nWaiting for responses...")
-    while len(results) < len(prompts):
-        time.sleep(1)
+    done.wait()
     
     print("\nAll responses received!")
     for i, result in enumerate(results, 1):
@@ -95,7 +101,7 @@ def example_rest_api():
     
     try:
         # Check health
-        response = requests.get(f"{base_url}/health")
+        response = SESSION.get(f"{base_url}/health")
         if response.status_code == 200:
             health = response.json()
             print(f"Server Status: {health['status']}")
@@ -108,7 +114,7 @@ def example_rest_api():
         }
         
         print("\nSending prompt via REST API...")
-        response = requests.post(f"{base_url}/prompt", json=prompt_data)
+        response = SESSION.post(f"{base_url}/prompt", json=prompt_data)
         
         if response.status_code == 200:
             result = response.json()
@@ -123,17 +129,19 @@ def example_rest_api():
         }
         
         print("\nSending async prompt...")
-        response = requests.post(f"{base_url}/prompt/async", json=async_data)
+        response = SESSION.post(f"{base_url}/prompt/async", json=async_data)
         
         if response.status_code == 200:
             job_info = response.json()
             job_id = job_info["job_id"]
             print(f"Job ID: {job_id}")
             
-            # Poll for result
+            # Long-poll for result; the server holds the request until the job finishes
+            poll = SESSION.prepare_request(
+                requests.Request('GET', f"{base_url}/job/{job_id}", params={"wait": 30})
+            )
             while True:
-                time.sleep(2)
-                response = requests.get(f"{base_url}/job/{job_id}")
+                response = SESSION.send(poll)
                 job_status = response.json()
                 
                 if job_status["status"] == "completed":
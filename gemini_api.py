@@ -5,160 +5,317 @@ Handles rate limiting (1000 requests/hour) and provides a clean interface
 """
 
 import subprocess
+import shutil
 import json
 import time
-import sqlite3
+import math
+import atexit
 import os
-from datetime import datetime, timedelta
+from datetime import date
 from typing import Optional, Dict, List
 from pathlib import Path
 import threading
 import queue
 import hashlib
+import random
+import re
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+WINDOW_SECONDS = 3600
+COMMAND_TIMEOUT = 300  # 5 minute timeout
+MAX_BATCH_WORKERS = 16
+BACKOFF_CAP = 30  # Longest sleep between retries, in seconds
+
+# An HTTP status only counts when it follows a status/code/error label,
+# e.g. "status 429", "HTTP/1.1 503", '"code": 401', "Error 403:"
+_STATUS = r"(?:status(?:\s*code)?|code|error|http(?:/\d(?:\.\d)?)?)[\s:=\"'(]*"
+
+# Patterns over stderr used to decide whether a failure is worth retrying
+ERROR_PATTERNS = [
+    ("rate_limit", re.compile(
+        rf"\b{_STATUS}429\b|\btoo many requests\b|\brate[ _-]?limit|\bquota\b|\bresource_exhausted\b",
+        re.IGNORECASE)),
+    ("auth", re.compile(
+        rf"\b{_STATUS}40[13]\b|\bunauthenticated\b|\bunauthorized\b|\bpermission[ _]denied\b"
+        r"|\bapi[ _-]?key\b|\bnot logged in\b|\blogin required\b",
+        re.IGNORECASE)),
+    ("network", re.compile(
+        rf"\b{_STATUS}(?:50[234]|unavailable)\b|\b(?:econnreset|econnrefused|etimedout|enotfound|eai_again)\b"
+        r"|\bsocket hang up\b|\bnetwork (?:error|is unreachable)\b|\bservice unavailable\b",
+        re.IGNORECASE)),
+]
+RETRYABLE_ERRORS = {"timeout", "rate_limit", "network"}
+
+
+def classify_error(error: Optional[str]) -> str:
+    """Classify a failed command's error as timeout, rate_limit, auth, network or other"""
+    if not error:
+        return "other"
+    if error.startswith("Command timed out"):
+        return "timeout"
+    for error_type, pattern in ERROR_PATTERNS:
+        if pattern.search(error):
+            return error_type
+    return "other"
+
 
 class GeminiRateLimiter:
     def __init__(self, max_requests_per_hour=950):  # Conservative limit
         self.max_requests = max_requests_per_hour
-        self.db_path = Path.home() / ".gemini_rate_limit.db"
-        self.init_db()
+        self.state_path = Path.home() / ".gemini_rate_limit.json"
         self.lock = threading.Lock()
+        
+        # Sliding-window counter: the previous full hour is weighted by how
+        # much of it still overlaps the rolling hour ending now
+        self.prev_count = 0
+        self.curr_count = 0
+        self.window_start = time.monotonic()
+        self.today = date.today()
+        self.today_count = 0
+        
+        self.load_state()
+        atexit.register(self.save_state)
     
-    def init_db(self):
-        conn = sqlite3.connect(str(self.db_path))
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                prompt_hash TEXT,
-                response_length INTEGER
-            )
-        ''')
-        conn.commit()
-        conn.close()
+    def load_state(self):
+        """Restore the counters saved by a previous process, if any"""
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            age = time.time() - state["window_start"]
+            if 0 <= age < 2 * WINDOW_SECONDS:
+                self.prev_count = int(state["prev_count"])
+                self.curr_count = int(state["curr_count"])
+                self.window_start = time.monotonic() - age
+            if state.get("today") == self.today.isoformat():
+                self.today_count = state.get("today_count", 0)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    
+    def save_state(self):
+        """Persist a small snapshot of the counters so limits survive restarts"""
+        with self.lock:
+            elapsed = self._advance_window()
+            state = {
+                "prev_count": self.prev_count,
+                "curr_count": self.curr_count,
+                "window_start": time.time() - elapsed,
+                "today": self.today.isoformat(),
+                "today_count": self.today_count
+            }
+        try:
+            with open(self.state_path, 'w') as f:
+                json.dump(state, f)
+        except OSError:
+            pass
+    
+    def _advance_window(self) -> float:
+        """Roll the window forward and return seconds elapsed in the current one"""
+        # Caller must hold self.lock
+        elapsed = time.monotonic() - self.window_start
+        if elapsed >= WINDOW_SECONDS:
+            windows = int(elapsed // WINDOW_SECONDS)
+            self.prev_count = self.curr_count if windows == 1 else 0
+            self.curr_count = 0
+            self.window_start += windows * WINDOW_SECONDS
+            elapsed -= windows * WINDOW_SECONDS
+        return elapsed
+    
+    def _weighted_count(self, elapsed: float) -> float:
+        return self.prev_count * (1 - elapsed / WINDOW_SECONDS) + self.curr_count
+    
+    def _roll_day(self):
+        # Caller must hold self.lock
+        today = date.today()
+        if today != self.today:
+            self.today = today
+            self.today_count = 0
+    
+    def _wait_seconds(self, elapsed: float) -> int:
+        """Seconds until the weighted count drops below the limit"""
+        # Caller must hold self.lock
+        if self.curr_count >= self.max_requests:
+            # Nothing frees up before the window rolls over; after that the
+            # current count becomes the previous one and decays linearly
+            wait_seconds = (WINDOW_SECONDS - elapsed) + \
+                WINDOW_SECONDS * (1 - self.max_requests / self.curr_count)
+        else:
+            wait_seconds = WINDOW_SECONDS * (1 - (self.max_requests - self.curr_count) / self.prev_count) - elapsed
+        return max(1, int(math.ceil(wait_seconds)))
     
     def can_make_request(self) -> tuple[bool, Optional[int]]:
         with self.lock:
-            conn = sqlite3.connect(str(self.db_path))
-            cursor = conn.cursor()
+            elapsed = self._advance_window()
             
-            # Clean old requests (older than 1 hour)
-            cursor.execute('''
-                DELETE FROM requests 
-                WHERE timestamp < datetime('now', '-1 hour')
-            ''')
+            if self._weighted_count(elapsed) < self.max_requests:
+                return True, None
+            return False, self._wait_seconds(elapsed)
+    
+    def try_acquire(self) -> tuple[bool, Optional[int]]:
+        """Check the limit and reserve a slot in one step
+        
+        Concurrent callers can't all pass the check before any of them is
+        counted. Call release() if the request doesn't go through.
+        """
+        with self.lock:
+            elapsed = self._advance_window()
             
-            # Count recent requests
-            cursor.execute('''
-                SELECT COUNT(*) FROM requests 
-                WHERE timestamp > datetime('now', '-1 hour')
-            ''')
-            count = cursor.fetchone()[0]
-            conn.close()
+            if self._weighted_count(elapsed) >= self.max_requests:
+                return False, self._wait_seconds(elapsed)
             
-            if count < self.max_requests:
-                return True, None
-            else:
-                # Calculate wait time until oldest request expires
-                conn = sqlite3.connect(str(self.db_path))
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT MIN(timestamp) FROM requests 
-                    WHERE timestamp > datetime('now', '-1 hour')
-                ''')
-                oldest = cursor.fetchone()[0]
-                conn.close()
-                
-                if oldest:
-                    oldest_time = datetime.fromisoformat(oldest)
-                    wait_until = oldest_time + timedelta(hours=1)
-                    wait_seconds = (wait_until - datetime.now()).total_seconds()
-                    return False, max(1, int(wait_seconds))
-                return False, 60
+            self.curr_count += 1
+            self._roll_day()
+            self.today_count += 1
+            return True, None
+    
+    def release(self):
+        """Give back a slot from try_acquire() whose request failed"""
+        with self.lock:
+            self._advance_window()
+            # The window may have rolled since the slot was taken
+            if self.curr_count > 0:
+                self.curr_count -= 1
+            elif self.prev_count > 0:
+                self.prev_count -= 1
+            if self.today_count > 0:
+                self.today_count -= 1
     
     def record_request(self, prompt: str, response_length: int = 0):
+        """Count a request that didn't go through try_acquire()"""
         with self.lock:
-            prompt_hash = hashlib.md5(prompt.encode()).hexdigest()
-            conn = sqlite3.connect(str(self.db_path))
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO requests (prompt_hash, response_length) 
-                VALUES (?, ?)
-            ''', (prompt_hash, response_length))
-            conn.commit()
-            conn.close()
+            self._advance_window()
+            self.curr_count += 1
+            self._roll_day()
+            self.today_count += 1
     
     def get_usage_stats(self) -> Dict:
-        conn = sqlite3.connect(str(self.db_path))
-        cursor = conn.cursor()
-        
-        # Requests in last hour
-        cursor.execute('''
-            SELECT COUNT(*) FROM requests 
-            WHERE timestamp > datetime('now', '-1 hour')
-        ''')
-        hour_count = cursor.fetchone()[0]
-        
-        # Requests today
-        cursor.execute('''
-            SELECT COUNT(*) FROM requests 
-            WHERE timestamp > datetime('now', 'start of day')
-        ''')
-        today_count = cursor.fetchone()[0]
-        
-        conn.close()
+        with self.lock:
+            elapsed = self._advance_window()
+            self._roll_day()
+            hour_count = int(math.ceil(self._weighted_count(elapsed)))
+            today_count = self.today_count
         
         return {
             "requests_last_hour": hour_count,
             "requests_today": today_count,
-            "remaining_this_hour": self.max_requests - hour_count,
+            "remaining_this_hour": max(0, self.max_requests - hour_count),
             "max_per_hour": self.max_requests
         }
 
 
+class CommandResult(dict):
+    """Successful command result whose "command" string is only built on access
+    
+    The key is absent from iteration and JSON output; result["command"]
+    still works for callers that expect it.
+    """
+    
+    def __init__(self, cmd: List[str], **fields):
+        super().__init__(**fields)
+        self._cmd = cmd
+    
+    def __missing__(self, key):
+        if key == "command":
+            return " ".join(self._cmd)
+        raise KeyError(key)
+    
+    def copy(self):
+        return CommandResult(self._cmd, **self)
+
+
+class TTLLRUCache:
+    """Thread-safe LRU cache whose entries expire after ttl_seconds"""
+    
+    def __init__(self, max_size=1024, ttl_seconds=3600):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self.lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            if time.monotonic() - entry[0] > self.ttl:
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = entry
+            return entry[1]
+    
+    def set(self, key, value):
+        with self.lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic(), value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+
+
 class GeminiAPI:
     def __init__(self, 
                  auto_approve=True, 
                  checkpointing=True,
                  max_retries=3,
-                 rate_limit_per_hour=950):
+                 rate_limit_per_hour=950,
+                 cache_size=1024,
+                 cache_ttl=3600):
         self.auto_approve = auto_approve
         self.checkpointing = checkpointing
+        # Flags fixed for the lifetime of this instance
+        self._cmd_prefix = ("gemini",) + (("--yolo",) if auto_approve else ()) + \
+            (("--checkpointing",) if checkpointing else ())
         self.rate_limiter = GeminiRateLimiter(rate_limit_per_hour)
         self.max_retries = max_retries
-        self.request_queue = queue.Queue()
-        self.response_cache = {}
+        self.request_queue = queue.SimpleQueue()  # Single consumer, no join() needed
+        self.response_cache = TTLLRUCache(max_size=cache_size, ttl_seconds=cache_ttl)
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        
+        # gemini has no long-lived stdin mode to pool, so make each launch
+        # cheap instead: an absolute executable plus close_fds=False lets
+        # subprocess use posix_spawn rather than fork/exec
+        self._gemini_executable = shutil.which("gemini")
         
         # Start background worker thread
         self.worker_thread = threading.Thread(target=self._process_queue, daemon=True)
         self.worker_thread.start()
     
-    def _execute_gemini_command(self, prompt: str, extra_flags: List[str] = None) -> Dict:
-        """Execute the gemini CLI command"""
-        cmd = ["gemini"]
-        
-        if self.auto_approve:
-            cmd.append("--yolo")
-        if self.checkpointing:
-            cmd.append("--checkpointing")
-        
+    def _build_command(self, prompt: str, extra_flags: List[str] = None) -> List[str]:
+        cmd = list(self._cmd_prefix)
         if extra_flags:
             cmd.extend(extra_flags)
         
-        cmd.extend(["-p", prompt])
+        cmd += ["-p", prompt]
+        return cmd
+    
+    def _execute_gemini_command(self, prompt: str, extra_flags: List[str] = None) -> Dict:
+        """Execute the gemini CLI command"""
+        cmd = self._build_command(prompt, extra_flags)
         
         try:
             result = subprocess.run(
                 cmd,
+                executable=self._gemini_executable,
                 capture_output=True,
                 text=True,
-                timeout=300  # 5 minute timeout
+                close_fds=False,
+                timeout=COMMAND_TIMEOUT
             )
             
+            if result.returncode == 0:
+                return CommandResult(cmd, success=True, output=result.stdout, error=None)
+            
             return {
-                "success": result.returncode == 0,
+                "success": False,
                 "output": result.stdout,
-                "error": result.stderr if result.returncode != 0 else None,
+                "error": result.stderr,
                 "command": " ".join(cmd)
             }
         except subprocess.TimeoutExpired:
@@ -176,63 +333,237 @@ class GeminiAPI:
                 "command": " ".join(cmd)
             }
     
+    def _execute_gemini_command_stream(self, prompt: str, extra_flags: List[str] = None):
+        """Execute the gemini CLI command, yielding stdout lines as they arrive
+        
+        Returns the same result dict as _execute_gemini_command once the
+        process exits.
+        """
+        cmd = self._build_command(prompt, extra_flags)
+        
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                executable=self._gemini_executable,
+                close_fds=False,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                bufsize=1
+            )
+        except Exception as e:
+            return {
+                "success": False,
+                "output": None,
+                "error": str(e),
+                "command": " ".join(cmd)
+            }
+        
+        # Drain stderr in the background so a chatty CLI can't fill the pipe
+        # and stall stdout
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+        drain.start()
+        
+        timed_out = threading.Event()
+        
+        def on_timeout():
+            timed_out.set()
+            proc.kill()
+        
+        timer = threading.Timer(COMMAND_TIMEOUT, on_timeout)
+        timer.start()
+        
+        output = []
+        try:
+            for line in proc.stdout:
+                output.append(line)
+                yield line
+            proc.wait()
+        finally:
+            # Also reached when the consumer stops early (e.g. client disconnect)
+            timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            drain.join()
+            proc.stdout.close()
+            proc.stderr.close()
+        
+        if timed_out.is_set():
+            return {
+                "success": False,
+                "output": None,
+                "error": "Command timed out after 5 minutes",
+                "command": " ".join(cmd)
+            }
+        
+        if proc.returncode == 0:
+            return CommandResult(cmd, success=True, output="".join(output), error=None)
+        
+        return {
+            "success": False,
+            "output": "".join(output),
+            "error": "".join(stderr),
+            "command": " ".join(cmd)
+        }
+    
+    def _cache_key(self, text: str, extra_flags: List[str] = None) -> str:
+        """Stable key for a prompt and the flags it is sent with"""
+        h = hashlib.blake2b(text.encode(), digest_size=16)
+        # Flag order is significant on the command line, so keep it; the
+        # NUL separators keep "foo" + ["x"] distinct from "foox" + []
+        for flag in extra_flags or ():
+            h.update(b"\x00")
+            h.update(flag.encode())
+        return h.hexdigest()
+    
     def prompt(self, text: str, extra_flags: List[str] = None, use_cache: bool = True) -> Dict:
         """Send a prompt to Gemini with rate limiting and retry logic"""
+        return self._prompt_inner(text, extra_flags, use_cache)
+    
+    def _prompt_inner(self, text: str, extra_flags: List[str] = None, use_cache: bool = True,
+                      cache_key: Optional[str] = None, reserved: bool = False) -> Dict:
+        """prompt(), optionally reusing a cache key the caller already computed
+        
+        reserved=True means the caller already holds a slot from
+        rate_limiter.try_acquire(); it is used for the upstream call or
+        released if the answer comes from the cache or a concurrent caller.
+        """
+        
+        if not use_cache:
+            return self._send_prompt(text, extra_flags, reserved=reserved)
         
         # Check cache first
-        cache_key = hashlib.md5(f"{text}{extra_flags}".encode()).hexdigest()
-        if use_cache and cache_key in self.response_cache:
-            cached = self.response_cache[cache_key]
+        if cache_key is None:
+            cache_key = self._cache_key(text, extra_flags)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            if reserved:
+                self.rate_limiter.release()
+            cached = cached.copy()
             cached["from_cache"] = True
+            cached["usage"] = self.rate_limiter.get_usage_stats()
             return cached
         
-        # Check rate limit
-        can_proceed, wait_time = self.rate_limiter.can_make_request()
+        # Coalesce concurrent identical prompts into a single upstream call
+        with self._inflight_lock:
+            future = self._inflight.get(cache_key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._inflight[cache_key] = future
         
-        if not can_proceed:
-            return {
-                "success": False,
-                "error": f"Rate limit reached. Please wait {wait_time} seconds.",
-                "wait_time": wait_time,
-                "usage": self.rate_limiter.get_usage_stats()
-            }
+        if not is_leader:
+            if reserved:
+                self.rate_limiter.release()
+            return future.result().copy()
+        
+        try:
+            result = self._send_prompt(text, extra_flags, cache_key, reserved)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(cache_key, None)
+        
+        return result
+    
+    def _send_prompt(self, text: str, extra_flags: List[str] = None, cache_key: Optional[str] = None,
+                     reserved: bool = False) -> Dict:
+        """Run a prompt through the rate limiter and retry loop, caching under cache_key if given"""
+        
+        # Check rate limit, reserving the slot so concurrent callers can't overshoot
+        if not reserved:
+            can_proceed, wait_time = self.rate_limiter.try_acquire()
+            
+            if not can_proceed:
+                return self._rate_limited_result(wait_time)
         
         # Attempt with retries
-        last_error = None
-        for attempt in range(self.max_retries):
-            if attempt > 0:
-                time.sleep(2 ** attempt)  # Exponential backoff
+        attempt, last_error, error_type = 0, None, None
+        for attempt in range(1, self.max_retries + 1):
+            if attempt > 1:
+                # Jittered exponential backoff so concurrent callers don't retry in lockstep
+                time.sleep(min(BACKOFF_CAP, (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)))
             
             result = self._execute_gemini_command(text, extra_flags)
             
             if result["success"]:
-                # Record successful request
-                self.rate_limiter.record_request(text, len(result.get("output", "")))
-                
-                # Cache result
-                if use_cache:
-                    self.response_cache[cache_key] = result
-                
-                result["usage"] = self.rate_limiter.get_usage_stats()
-                result["attempt"] = attempt + 1
-                return result
+                return self._record_success(result, cache_key, attempt)
             
             last_error = result["error"]
+            error_type = classify_error(last_error)
+            if error_type not in RETRYABLE_ERRORS:
+                break
         
-        # All retries failed
+        # All retries failed, or the error wasn't worth retrying; only successes count
+        self.rate_limiter.release()
         return {
             "success": False,
-            "error": f"Failed after {self.max_retries} attempts. Last error: {last_error}",
+            "error": f"Failed after {attempt} attempts. Last error: {last_error}",
+            "error_type": error_type,
             "usage": self.rate_limiter.get_usage_stats()
         }
     
+    def prompt_stream(self, text: str, extra_flags: List[str] = None, use_cache: bool = True):
+        """Send a prompt to Gemini, yielding output lines as they arrive
+        
+        Returns the final result dict, as prompt() would, when exhausted.
+        Streamed output can't be taken back, so failed attempts are not retried.
+        """
+        cache_key = self._cache_key(text, extra_flags) if use_cache else None
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                cached = cached.copy()
+                cached["from_cache"] = True
+                cached["usage"] = self.rate_limiter.get_usage_stats()
+                if cached["output"]:
+                    yield cached["output"]
+                return cached
+        
+        can_proceed, wait_time = self.rate_limiter.try_acquire()
+        if not can_proceed:
+            return self._rate_limited_result(wait_time)
+        
+        result = yield from self._execute_gemini_command_stream(text, extra_flags)
+        
+        if not result["success"]:
+            self.rate_limiter.release()
+            result["usage"] = self.rate_limiter.get_usage_stats()
+            return result
+        
+        return self._record_success(result, cache_key, 1)
+    
+    def _rate_limited_result(self, wait_time: int) -> Dict:
+        return {
+            "success": False,
+            "error": f"Rate limit reached. Please wait {wait_time} seconds.",
+            "wait_time": wait_time,
+            "usage": self.rate_limiter.get_usage_stats()
+        }
+    
+    def _record_success(self, result: Dict, cache_key: Optional[str], attempt: int) -> Dict:
+        """Cache a successful request and attach usage info"""
+        result["attempt"] = attempt
+        
+        # Cache result; usage is attached fresh on every hit
+        if cache_key is not None:
+            self.response_cache.set(cache_key, result.copy())
+        
+        result["usage"] = self.rate_limiter.get_usage_stats()
+        return result
+    
     def prompt_async(self, text: str, callback=None, extra_flags: List[str] = None):
         """Queue a prompt for async processing"""
         request = {
             "prompt": text,
             "extra_flags": extra_flags,
             "callback": callback,
-            "timestamp": datetime.now()
+            "timestamp": time.monotonic()
         }
         self.request_queue.put(request)
         return {"queued": True, "queue_size": self.request_queue.qsize()}
@@ -240,44 +571,69 @@ class GeminiAPI:
     def _process_queue(self):
         """Background worker to process queued requests"""
         while True:
+            request = self.request_queue.get()
+            if request is None:  # Sentinel from shutdown()
+                break
+            
             try:
-                request = self.request_queue.get(timeout=1)
                 result = self.prompt(request["prompt"], request.get("extra_flags"))
-                
-                if request.get("callback"):
-                    request["callback"](result)
-                
-                self.request_queue.task_done()
-            except queue.Empty:
-                continue
             except Exception as e:
                 print(f"Queue processing error: {e}")
+                # Still report back so callers waiting on the callback aren't left hanging
+                result = {"success": False, "error": f"Queue processing error: {e}"}
+            
+            if request.get("callback"):
+                try:
+                    request["callback"](result)
+                except Exception as e:
+                    print(f"Queue callback error: {e}")
+    
+    def shutdown(self, wait: bool = True):
+        """Stop the background worker once already-queued requests are processed"""
+        self.request_queue.put(None)
+        if wait:
+            self.worker_thread.join()
     
     def get_usage(self) -> Dict:
         """Get current usage statistics"""
         return self.rate_limiter.get_usage_stats()
     
     def batch_prompts(self, prompts: List[str], parallel: bool = False) -> List[Dict]:
-        """Process multiple prompts, respecting rate limits"""
-        results = []
+        """Process multiple prompts, respecting rate limits
         
-        for i, prompt in enumerate(prompts):
-            print(f"Processing prompt {i+1}/{len(prompts)}...")
-            
-            # Check if we need to wait
-            can_proceed, wait_time = self.rate_limiter.can_make_request()
-            if not can_proceed:
-                print(f"Rate limit reached. Waiting {wait_time} seconds...")
-                time.sleep(wait_time)
-            
-            result = self.prompt(prompt)
-            results.append(result)
-            
-            # Small delay between requests
-            if i < len(prompts) - 1:
-                time.sleep(1)
+        With parallel=True prompts are sent from a thread pool; the rate
+        limiter is what throttles them.
+        """
+        total = len(prompts)
+        if not parallel or total < 2:
+            return [self._batch_prompt(i, prompt, total) for i, prompt in enumerate(prompts)]
+        
+        with ThreadPoolExecutor(max_workers=min(MAX_BATCH_WORKERS, total)) as executor:
+            return list(executor.map(lambda job: self._batch_prompt(*job, total), enumerate(prompts)))
+    
+    def _batch_prompt(self, i: int, prompt: str, total: int) -> Dict:
+        print(f"Processing prompt {i+1}/{total}...")
+        
+        # A bad item fails on its own instead of aborting the whole batch
+        if not isinstance(prompt, str):
+            return {
+                "success": False,
+                "error": f"Prompt must be a string, got {type(prompt).__name__}"
+            }
+        
+        # Hash once here and hand the key on so _prompt_inner doesn't rehash
+        cache_key = self._cache_key(prompt)
+        
+        # Reserve a slot here, waiting as needed, and hand it to _prompt_inner
+        # so the limit is checked once and can't be taken by another worker
+        while True:
+            can_proceed, wait_time = self.rate_limiter.try_acquire()
+            if can_proceed:
+                break
+            print(f"Rate limit reached. Waiting {wait_time} seconds...")
+            time.sleep(wait_time)
         
-        return results
+        return self._prompt_inner(prompt, cache_key=cache_key, reserved=True)
 
 
 # CLI Interface
@@ -291,6 +647,7 @@ if __name__ == "__main__":
     parser.add_argument("--stats", action="store_true", help="Show usage statistics")
     parser.add_argument("--batch", type=str, help="File with prompts (one per line)")
     parser.add_argument("--output", type=str, help="Output file for batch results")
+    parser.add_argument("--parallel", action="store_true", help="Send batch prompts concurrently")
     parser.add_argument("--json", action="store_true", help="Output as JSON")
     
     args = parser.parse_args()
@@ -313,7 +670,7 @@ if __name__ == "__main__":
         with open(args.batch, 'r') as f:
             prompts = [line.strip() for line in f if line.strip()]
         
-        results = api.batch_prompts(prompts)
+        results = api.batch_prompts(prompts, parallel=args.parallel)
         
         if args.output:
             with open(args.output, 'w') as f:
@@ -5,15 +5,27 @@ Provides HTTP endpoints for the Gemini CLI wrapper
 """
 
 from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import json
+import orjson
 import threading
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from gemini_api import GeminiAPI
 import logging
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Serialize responses with orjson instead of the stdlib encoder"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # Configure logging
@@ -23,9 +35,117 @@ logger = logging.getLogger(__name__)
 # Initialize Gemini API
 gemini = GeminiAPI(auto_approve=True, checkpointing=True)
 
-# Store for async job results
-job_results = {}
-job_lock = threading.Lock()
+
+class BoundedJobStore:
+    """Job results keyed by job_id. Completed jobs are dropped ttl seconds
+    after completion, and the oldest completed jobs beyond max_jobs are
+    trimmed. Jobs still processing are kept until running_ttl, a backstop
+    for jobs that never report back. Not thread-safe; guard with the
+    shard's lock from _job_shard()."""
+    
+    def __init__(self, max_jobs=10_000, ttl=3600, running_ttl=24 * 3600):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.running_ttl = running_ttl
+        self._running = OrderedDict()  # job_id -> (started, job), oldest first
+        self._completed = OrderedDict()  # job_id -> (completed, job), oldest first
+    
+    @staticmethod
+    def _expire(jobs, cutoff):
+        while jobs:
+            written, _ = next(iter(jobs.values()))
+            if written >= cutoff:
+                break
+            jobs.popitem(last=False)
+    
+    def _evict(self):
+        now = time.monotonic()
+        self._expire(self._running, now - self.running_ttl)
+        self._expire(self._completed, now - self.ttl)
+        while len(self._completed) > self.max_jobs:
+            self._completed.popitem(last=False)
+    
+    def __setitem__(self, job_id, job):
+        if job.get("status") == "processing":
+            if job_id not in self._running:
+                self._running[job_id] = (time.monotonic(), job)
+        else:
+            self._running.pop(job_id, None)
+            if job_id not in self._completed:
+                self._completed[job_id] = (time.monotonic(), job)
+        self._evict()
+    
+    def get(self, job_id, default=None):
+        now = time.monotonic()
+        entry = self._running.get(job_id)
+        if entry is not None:
+            return entry[1] if entry[0] >= now - self.running_ttl else default
+        entry = self._completed.get(job_id)
+        if entry is None or entry[0] < now - self.ttl:
+            return default
+        return entry[1]
+    
+    def items(self):
+        self._evict()
+        return [(job_id, job) for jobs in (self._running, self._completed) for job_id, (_, job) in jobs.items()]
+    
+    def __len__(self):
+        return len(self._running) + len(self._completed)
+
+
+# Store for async job results, sharded so concurrent lookups of different
+# jobs don't contend on one lock
+JOB_SHARDS = 16
+job_stores = [BoundedJobStore(max_jobs=10_000 // JOB_SHARDS, ttl=3600) for _ in range(JOB_SHARDS)]
+job_locks = [threading.Lock() for _ in range(JOB_SHARDS)]
+
+# Upper bound for /job/<id>?wait=N long-polling. Each waiting request holds
+# a server thread for up to this long, so size --threads accordingly
+MAX_JOB_WAIT = 30
+
+
+def _job_shard(job_id):
+    """Lock and store responsible for job_id"""
+    shard = hash(job_id) % JOB_SHARDS
+    return job_locks[shard], job_stores[shard]
+
+
+def _start_job(job_id, **fields):
+    """Register a new job as processing"""
+    job = {"status": "processing", "started_at": time.time(), "event": threading.Event(), **fields}
+    lock, store = _job_shard(job_id)
+    with lock:
+        store[job_id] = job
+
+
+def _finish_job(job_id, **fields):
+    """Mark a job completed and wake any long-polling readers"""
+    completed_at = time.time()
+    lock, store = _job_shard(job_id)
+    with lock:
+        job = store.get(job_id)
+        if job is None:
+            return  # Dropped by the running_ttl backstop
+        job.update(status="completed", completed_at=completed_at, **fields)
+        store[job_id] = job  # Starts the job's TTL
+    job["event"].set()
+
+
+def _sse_event(data):
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+
+def _isoformat(ts):
+    return datetime.fromtimestamp(ts).isoformat() if ts is not None else None
+
+
+def _job_view(job):
+    """Job data for responses: ISO timestamps and no internal completion event"""
+    view = {k: v for k, v in job.items() if k != "event"}
+    for key in ("started_at", "completed_at"):
+        if key in view:
+            view[key] = _isoformat(view[key])
+    return view
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -69,23 +189,16 @@ def prompt_async():
         data = request.json
         if not data or 'prompt' not in data:
             return jsonify({"error": "Missing 'prompt' in request body"}), 400
+        if not isinstance(data['prompt'], str):
+            return jsonify({"error": "'prompt' must be a string"}), 400
         
         job_id = str(uuid.uuid4())
         
         def callback(result):
-            with job_lock:
-                job_results[job_id] = {
-                    "status": "completed",
-                    "result": result,
-                    "completed_at": datetime.now().isoformat()
-                }
+            _finish_job(job_id, result=result)
         
         # Initialize job status
-        with job_lock:
-            job_results[job_id] = {
-                "status": "processing",
-                "started_at": datetime.now().isoformat()
-            }
+        _start_job(job_id)
         
         gemini.prompt_async(
             data['prompt'],
@@ -105,12 +218,20 @@ def prompt_async():
 
 @app.route('/job/<job_id>', methods=['GET'])
 def get_job(job_id):
-    """Check status of an async job"""
-    with job_lock:
-        if job_id not in job_results:
-            return jsonify({"error": "Job not found"}), 404
-        
-        return jsonify(job_results[job_id])
+    """Check status of an async job, optionally blocking up to ?wait=N seconds"""
+    lock, store = _job_shard(job_id)
+    with lock:
+        job = store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    wait = request.args.get('wait', type=float)
+    if wait and wait > 0:
+        job["event"].wait(timeout=min(wait, MAX_JOB_WAIT))
+    
+    with lock:
+        view = _job_view(job)
+    return jsonify(view)
 
 @app.route('/batch', methods=['POST'])
 def batch():
@@ -121,28 +242,27 @@ def batch():
             return jsonify({"error": "Missing 'prompts' in request body"}), 400
         
         prompts = data['prompts']
-        if not isinstance(prompts, list):
-            return jsonify({"error": "'prompts' must be a list"}), 400
+        if not isinstance(prompts, list) or not all(isinstance(p, str) for p in prompts):
+            return jsonify({"error": "'prompts' must be a list of strings"}), 400
+        
+        parallel = bool(data.get('parallel', False))
         
         # Process in background
         job_id = str(uuid.uuid4())
         
         def process_batch():
-            results = gemini.batch_prompts(prompts)
-            with job_lock:
-                job_results[job_id] = {
-                    "status": "completed",
-                    "results": results,
-                    "completed_at": datetime.now().isoformat()
-                }
+            # Always complete the job, or it would report "processing" forever
+            fields = {"error": "Batch processing was interrupted"}
+            try:
+                fields = {"results": gemini.batch_prompts(prompts, parallel=parallel)}
+            except Exception as e:
+                logger.error(f"Error processing batch {job_id}: {e}")
+                fields = {"error": str(e)}
+            finally:
+                _finish_job(job_id, **fields)
         
         # Initialize job status
-        with job_lock:
-            job_results[job_id] = {
-                "status": "processing",
-                "total_prompts": len(prompts),
-                "started_at": datetime.now().isoformat()
-            }
+        _start_job(job_id, total_prompts=len(prompts))
         
         thread = threading.Thread(target=process_batch)
         thread.start()
@@ -168,16 +288,23 @@ def stream():
         
         def generate():
             # Send initial status
-            yield f"data: {json.dumps({'status': 'processing'})}\n\n"
+            yield _sse_event({'status': 'processing'})
             
-            # Process prompt
-            result = gemini.prompt(data['prompt'], extra_flags=data.get('extra_flags', []))
+            # Forward output as the CLI produces it
+            stream = gemini.prompt_stream(data['prompt'], extra_flags=data.get('extra_flags', []))
+            while True:
+                try:
+                    chunk = next(stream)
+                except StopIteration as done:
+                    result = done.value
+                    break
+                yield _sse_event({'chunk': chunk})
             
             # Send result
-            yield f"data: {json.dumps(result)}\n\n"
+            yield _sse_event(result)
             
             # Send completion
-            yield f"data: {json.dumps({'status': 'completed'})}\n\n"
+            yield _sse_event({'status': 'completed'})
         
         return Response(generate(), mimetype='text/event-stream')
     
@@ -188,16 +315,24 @@ def stream():
 @app.route('/jobs', methods=['GET'])
 def list_jobs():
     """List all jobs"""
-    with job_lock:
-        jobs = []
-        for job_id, job_data in job_results.items():
-            jobs.append({
-                "job_id": job_id,
-                "status": job_data.get("status"),
-                "started_at": job_data.get("started_at"),
-                "completed_at": job_data.get("completed_at")
-            })
-        return jsonify({"jobs": jobs, "total": len(jobs)})
+    jobs = []
+    for lock, store in zip(job_locks, job_stores):
+        with lock:
+            for job_id, job_data in store.items():
+                jobs.append((job_data.get("started_at"), {
+                    "job_id": job_id,
+                    "status": job_data.get("status"),
+                    "started_at": job_data.get("started_at"),
+                    "completed_at": job_data.get("completed_at")
+                }))
+    
+    # Shards don't preserve creation order across each other
+    jobs.sort(key=lambda item: item[0])
+    jobs = [job for _, job in jobs]
+    for job in jobs:
+        job["started_at"] = _isoformat(job["started_at"])
+        job["completed_at"] = _isoformat(job["completed_at"])
+    return jsonify({"jobs": jobs, "total": len(jobs)})
 
 @app.route('/cache/clear', methods=['POST'])
 def clear_cache():
@@ -208,10 +343,18 @@ def clear_cache():
 if __name__ == '__main__':
     import argparse
     
-    parser = argparse.ArgumentParser(description="Gemini REST API Server")
+    parser = argparse.ArgumentParser(
+        description="Gemini REST API Server",
+        epilog="Serves with waitress. To run under gunicorn instead, keep a single worker "
+               "so jobs, cache and rate limits stay in one process: "
+               "gunicorn --workers 1 --threads 32 --worker-class gthread gemini_server:app"
+    )
     parser.add_argument('--host', default='127.0.0.1', help='Host to bind to')
     parser.add_argument('--port', type=int, default=5000, help='Port to bind to')
-    parser.add_argument('--debug', action='store_true', help='Enable debug mode')
+    parser.add_argument('--threads', type=int, default=32,
+                        help='Worker threads for concurrent requests. Each /job/<id>?wait=N long-poll '
+                             f'holds one for up to {MAX_JOB_WAIT}s, so allow for your expected pollers')
+    parser.add_argument('--debug', action='store_true', help='Enable debug mode (Flask dev server)')
     
     args = parser.parse_args()
     
@@ -222,10 +365,14 @@ if __name__ == '__main__':
     print("  GET  /usage          - Current usage statistics")
     print("  POST /prompt         - Send a prompt (sync)")
     print("  POST /prompt/async   - Queue a prompt (async)")
-    print("  GET  /job/<id>       - Check job status")
+    print("  GET  /job/<id>       - Check job status (?wait=N to long-poll)")
     print("  POST /batch          - Process multiple prompts")
     print("  POST /stream         - Stream responses (SSE)")
     print("  GET  /jobs           - List all jobs")
     print("  POST /cache/clear    - Clear response cache")
     
-    app.run(host=args.host, port=args.port, debug=args.debug)
\ No newline at end of file
+    if args.debug:
+        app.run(host=args.host, port=args.port, debug=True, threaded=True)
+    else:
+        from waitress import serve
+        serve(app, host=args.host, port=args.port, threads=args.threads)
\ No newline at end of file